@@ -1,12 +1,25 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import random
+import math
 import os
 import difflib
 import time
+import zipfile
 import csv
+import sqlite3
+import tempfile
+from collections import namedtuple
+from contextlib import closing
 from datetime import datetime
 
+# 文字列の類似度計算はC++実装のRapidFuzzを優先（無ければdifflibで代用）
+try:
+    from rapidfuzz import fuzz, process
+except ImportError:
+    fuzz = None
+    process = None
 
 # ==========================================
 # 設定：ページの基本設定
@@ -17,116 +30,230 @@ st.set_page_config(
     initial_sidebar_state="collapsed"
 )
 
-# スタイル調整：ボタンを少し大きく見やすくするCSS（おまけ）
-st.markdown("""
-<style>
-div.stButton > button {
-    height: 3em;
-    font-size: 20px;
-    font-weight: bold;
-}
-/* 1. 基本のバー（問題番号）を青にする */
-.stProgress > div > div > div > div {
-    background-color: #007bff;
-}
-
-/* 2. 制限時間のバー（2つ目に表示されるバー）を赤で上書きする */
-/* ページ内の2番目のプログレスバーをターゲットにします */
-.stProgress:nth-of-type(2) > div > div > div > div {
-    background-color: #ff4b4b;
-}
-</style>
-""", unsafe_allow_html=True)
+# 再実行のたびに作り直さなくてよい設定は、プロセスごとに一度だけ作る
+@st.cache_resource
+def _page_init():
+    """ファイルパス・コース一覧・CSSを用意する"""
+    base_dir = os.getcwd()
+    # スタイル調整用のCSS（assets/style.css）
+    with open(os.path.join(base_dir, "assets", "style.css"), encoding='utf-8') as f:
+        css = f.read()
+    return {
+        'base_dir': base_dir,
+        'css': css,
+        # コースとファイル名の対応表
+        'files': {
+            "テスト用":"toeic_words_gemini.xlsx",
+            "TOEIC 黒フレ": "toeic_words.xlsx",
+            "TOEIC 復習モード": "toeic_words.xlsx"
+        }
+    }
+
+_page = _page_init()
+
+# CSSは再実行ごとに出力しないと画面から消えるので、読み込み済みの文字列を一回渡すだけにする
+st.markdown(f"<style>{_page['css']}</style>", unsafe_allow_html=True)
 
 # ファイルパス設定
-BASE_DIR = os.getcwd()
-HISTORY_FILE = os.path.join(BASE_DIR, "history.csv") # 学習履歴保存用ファイル
+BASE_DIR = _page['base_dir']
+HISTORY_FILE = os.path.join(BASE_DIR, "history.db") # 学習履歴保存用ファイル（SQLite）
+LEGACY_HISTORY_FILE = os.path.join(BASE_DIR, "history.csv") # 以前のCSV形式の学習履歴
+HISTORY_FLUSH_SIZE = 10 # この件数たまったら学習履歴をファイルに書き出す
 
 # コースとファイル名の対応表
-QUIZ_FILES = {
-    "テスト用":"toeic_words_gemini.xlsx",
-    "TOEIC 黒フレ": "toeic_words.xlsx",
-    "TOEIC 復習モード": "toeic_words.xlsx"
-}
+QUIZ_FILES = _page['files']
+
+# 読み込んだ単語データ（words と meanings は同じ順番で並んでいる）
+# similar は意味同士が似ているかを表すN×Nのbool行列
+QuizData = namedtuple("QuizData", ["words", "meanings", "similar"])
 
 # ==========================================
 # 関数定義
 # ==========================================
-@st.cache_data
+# 単語データは変更しないので、cache_resourceでコピーせず同じオブジェクトを使い回す
+@st.cache_resource
 def load_data(filename):
     """Excelデータを読み込む関数"""
     file_path = os.path.join(BASE_DIR, filename)
-    if not os.path.exists(file_path):
-        return None
+    # Excelの隣に置くParquetキャッシュ（openpyxlより桁違いに速く読める）
+    cache_path = file_path + ".parquet"
     try:
-        df = pd.read_excel(file_path, engine='openpyxl')
-        if 'Word' not in df.columns or 'Meaning' not in df.columns:
-            return None
+        df = None
+        # キャッシュがExcelより新しければそちらを使う
+        if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(file_path):
+            try:
+                df = pd.read_parquet(cache_path, columns=['Word', 'Meaning'])
+            except Exception:
+                # pyarrowが無い・キャッシュが壊れている場合は、キャッシュを捨ててExcelから読む
+                df = None
+                try:
+                    os.remove(cache_path)
+                except OSError:
+                    pass
+
+        if df is None:
+            try:
+                df = read_word_sheet(file_path)
+            except ValueError:
+                return None # Word列かMeaning列が無い、またはExcelファイルとして読めない
+            # 次回の起動用にキャッシュを書き出す（失敗しても読み込みは続ける）
+            # 書きかけのファイルが残らないよう、一時ファイルに書いてから置き換える
+            tmp_path = None
+            try:
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix=".tmp.parquet")
+                os.close(fd)
+                df.to_parquet(tmp_path, engine='pyarrow', compression='zstd')
+                os.replace(tmp_path, cache_path)
+            except Exception:
+                if tmp_path is not None and os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
         df = df.dropna(subset=['Word', 'Meaning'])
-        return dict(zip(df['Word'], df['Meaning']))
-    except Exception:
+        # 同じ単語が複数行ある場合は最後の行を採用（同じ単語が出題・選択肢に重複しないようにする）
+        df = df.drop_duplicates(subset='Word', keep='last')
+        meanings = tuple(df['Meaning'])
+        return QuizData(
+            words=tuple(df['Word']),
+            meanings=meanings,
+            similar=build_similarity_matrix(meanings)
+        )
+    except (OSError, ValueError, KeyError):
+        # ファイルが無い（FileNotFoundError）・シートの形式がおかしい場合
         return None
 
-# 回答結果をCSVに記録する関数
-def save_history(word, is_correct):
-    """学習履歴を保存"""
-    # ファイルがなければヘッダーを作成
-    if not os.path.exists(HISTORY_FILE):
-        with open(HISTORY_FILE, mode='w', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow(["Word", "IsCorrect", "Timestamp"])
+def read_word_sheet(file_path):
+    """ExcelからWord列とMeaning列だけを文字列として読む（他の列の解析と型推論を省く）"""
+    options = {'usecols': ['Word', 'Meaning'], 'dtype': {'Word': str, 'Meaning': str}}
+    # Rust製のcalamineが入っていればそちらで読む（openpyxlより何倍も速い）
+    try:
+        return pd.read_excel(file_path, engine='calamine', **options)
+    except OSError:
+        raise # ファイルが無い場合はそのまま呼び出し元へ
+    except Exception:
+        # calamineが無い、pandas 2.2未満でcalamineエンジンに対応していない、
+        # またはcalamineが読めないファイル（CalamineError）の場合はopenpyxlで読み直す
+        pass
+    try:
+        return pd.read_excel(file_path, engine='openpyxl', **options)
+    except zipfile.BadZipFile as e:
+        # 壊れたファイルやGit LFSのポインタファイルなど、xlsx（zip）になっていない場合
+        raise ValueError(f"Excelファイルとして読み込めません: {file_path}") from e
+
+def open_history_db():
+    """学習履歴のデータベースを開く（テーブルが無ければ作成し、以前のCSVの履歴を取り込む）"""
+    conn = sqlite3.connect(HISTORY_FILE)
+    if not has_history_table(conn):
+        try:
+            create_history_table(conn)
+        except Exception:
+            conn.close()
+            raise
+    return conn
+
+def has_history_table(conn):
+    """history テーブルが作成済みかどうか"""
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'history'").fetchone()
+    return row is not None
+
+def create_history_table(conn):
+    """history テーブルを作り、以前のCSVの履歴を1つのトランザクションで取り込む"""
+    # 先に書き込みロックを取り、他のセッションと同時に作成・取り込みをしないようにする
+    # 途中で失敗したらテーブルごと巻き戻るので、履歴が空のテーブルだけが残ることもない
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if has_history_table(conn):
+            # ロック待ちの間に他のセッションが作成済み
+            conn.rollback()
+            return
+        conn.execute("CREATE TABLE history (Word TEXT, IsCorrect INTEGER, Timestamp TEXT)")
+        conn.execute("CREATE INDEX idx_history_word ON history (Word)")
+        if os.path.exists(LEGACY_HISTORY_FILE):
+            with open(LEGACY_HISTORY_FILE, newline='', encoding='utf-8-sig') as f:
+                reader = csv.DictReader(f)
+                conn.executemany(
+                    "INSERT INTO history VALUES (?, ?, ?)",
+                    ((row['Word'], int(row['IsCorrect']), row['Timestamp']) for row in reader)
+                )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    # 取り込み済みのCSVは、リセット後に再度取り込まれないよう名前を変えておく
+    if os.path.exists(LEGACY_HISTORY_FILE):
+        os.replace(LEGACY_HISTORY_FILE, LEGACY_HISTORY_FILE + ".bak")
 
-    # 追記モードで保存
-    with open(HISTORY_FILE, mode='a', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerow([word, 1 if is_correct else 0, datetime.now().isoformat()])
+# 回答結果をデータベースに記録する関数
+def save_history(word, is_correct):
+    """学習履歴を保存（いったんセッションにためて、まとめて書き出す）"""
+    # リストをその場で書き換えず、新しいリストに置き換える（fastReruns中でも状態が半端にならない）
+    buffer = st.session_state.get('history_buffer', []) + [[word, 1 if is_correct else 0, datetime.now().isoformat()]]
+    st.session_state.history_buffer = buffer
+
+    if len(buffer) >= HISTORY_FLUSH_SIZE:
+        flush_history()
+
+def flush_history():
+    """ためておいた学習履歴をデータベースに書き出す"""
+    buffer = st.session_state.get('history_buffer')
+    if not buffer:
+        return
+
+    # まとめて1回のトランザクションで追加
+    with closing(open_history_db()) as conn:
+        with conn:
+            conn.executemany("INSERT INTO history VALUES (?, ?, ?)", buffer)
+    st.session_state.history_buffer = []
+
+# 学習データの集計（ファイルの更新時刻をキーにして、更新されたときだけ読み直す）
+@st.cache_data(ttl=30)
+def load_history_stats(path, mtime):
+    """学習履歴を読み込んで、総回答数・正解数・日別の回答数を集計する"""
+    # 全行を読み込んで日時に変換せず、集計はSQLite側で行う
+    # （Timestampは ISO形式 なので、先頭10文字がそのまま日付になる）
+    with closing(sqlite3.connect(path)) as conn:
+        total, correct = conn.execute("SELECT COUNT(*), COALESCE(SUM(IsCorrect), 0) FROM history").fetchone()
+        daily = pd.read_sql_query(
+            "SELECT substr(Timestamp, 1, 10) AS Date, COUNT(*) AS count FROM history GROUP BY Date ORDER BY Date",
+            conn, index_col='Date'
+        )
+    # グラフの横軸を日付として扱うよう、日付の文字列を変換する（1日1件なので軽い）
+    daily.index = pd.to_datetime(daily.index)
+    return {
+        'total': total,
+        'correct': correct,
+        'daily': daily['count']
+    }
 
 # 苦手な単語を選びやすくするAIロジック
 def get_weighted_questions(words, num_questions):
-    """学習履歴を読み込み、苦手な単語が出やすくなるように重み付け抽選を行う"""
+    """学習履歴を読み込み、苦手な単語が出やすくなるように重み付け抽選を行う（単語の位置を返す）"""
     if not os.path.exists(HISTORY_FILE):
-        return random.sample(words, min(num_questions, len(words)))
+        return random.sample(range(len(words)), min(num_questions, len(words)))
 
     try:
-        history_df = pd.read_csv(HISTORY_FILE)
-        
-        # 単語ごとの「正解数」と「不正解数」を集計
-        stats = history_df.groupby("Word")["IsCorrect"].agg(['sum', 'count']).reset_index()
-        stats.rename(columns={'sum': 'corrects', 'count': 'total'}, inplace=True)
-        stats['wrongs'] = stats['total'] - stats['corrects']
-        
-        wrong_counts = dict(zip(stats['Word'], stats['wrongs']))
-        correct_counts = dict(zip(stats['Word'], stats['corrects']))
+        # 単語ごとの「正解数」と「不正解数」をSQLで集計し、出題候補の並び順に揃える（履歴に無い単語は0）
+        with closing(open_history_db()) as conn:
+            stats = pd.read_sql_query(
+                "SELECT Word, SUM(IsCorrect) AS sum, COUNT(*) AS count FROM history GROUP BY Word",
+                conn, index_col='Word'
+            )
+        stats = stats.reindex(pd.Index(words), fill_value=0)
+        corrects = stats['sum'].to_numpy()
+        wrongs = (stats['count'] - stats['sum']).to_numpy()
 
         # 重み（出やすさ）の計算
-        # 基本10 + (不正解数 × 20) - (正解数 × 2)
-        weights = []
-        for word in words:
-            w_count = wrong_counts.get(word, 0)
-            c_count = correct_counts.get(word, 0)
-            score = 10 + (w_count * 20) - (c_count * 2)
-            if score < 1: score = 1
-            weights.append(score)
+        # 基本10 + (不正解数 × 20) - (正解数 × 2)、最低でも1
+        weights = np.clip(10 + wrongs * 20 - corrects * 2, 1, None).astype(np.float64)
         
-        # 重複なしで重み付き抽選を行うロジック
-        selected_questions = []
-        temp_words = list(words)
-        temp_weights = list(weights)
-        
-        for _ in range(min(num_questions, len(words))):
-            chosen_list = random.choices(temp_words, weights=temp_weights, k=1)
-            chosen_word = chosen_list[0]
-            selected_questions.append(chosen_word)
-            
-            # 選ばれた単語を候補から削除
-            idx = temp_words.index(chosen_word)
-            temp_words.pop(idx)
-            temp_weights.pop(idx)
-            
-        return selected_questions
+        # 重複なしの重み付き抽選をnumpyで一度に行う
+        rng = np.random.default_rng()
+        selected_questions = rng.choice(
+            len(words), size=min(num_questions, len(words)), replace=False, p=weights / weights.sum()
+        )
+        return selected_questions.tolist()
 
     except Exception:
-        return random.sample(words, min(num_questions, len(words)))
+        return random.sample(range(len(words)), min(num_questions, len(words)))
 
 def is_similar(str1, str2, threshold=0.4):
     """
@@ -138,53 +265,104 @@ def is_similar(str1, str2, threshold=0.4):
     if str1 == str2:
         return True
     
+    # RapidFuzzがある場合は build_similarity_matrix が cdist で一括計算するので、
+    # ここに来るのはdifflibで代用するときだけ
     # SequenceMatcherで類似度(0.0~1.0)を計算
-    similarity = difflib.SequenceMatcher(None, str(str1), str(str2)).ratio()
+    # autojunk=Trueだと日本語でよく出る文字がジャンク扱いされ、類似度が狂うので無効にする
+    matcher = difflib.SequenceMatcher(None, str(str1), str(str2), autojunk=False)
+    # ratio()は重いので、必ずratio()以上になる安い上限値で「明らかに似ていない」組を先に弾く
+    if matcher.real_quick_ratio() <= threshold or matcher.quick_ratio() <= threshold:
+        return False
+    similarity = matcher.ratio()
     return similarity > threshold
 
+def build_similarity_matrix(meanings, threshold=0.4):
+    """
+    全ての意味同士の「似ている？」をまとめて判定し、N×Nのbool行列で返す
+    ファイル読み込み時に一度だけ計算し、出題時は行列を引くだけにする
+    """
+    texts = [str(m) for m in meanings]
+
+    # RapidFuzzがあれば全組み合わせを一回の呼び出しで計算（マルチスレッド）
+    if process is not None:
+        # スコアは0~100なのでuint8で受け取り、float64のN×N行列を作らないようにする
+        scores = process.cdist(
+            texts, texts, scorer=fuzz.ratio, score_cutoff=threshold * 100, dtype=np.uint8, workers=-1
+        )
+        return scores > threshold * 100
+
+    n = len(texts)
+    similar = np.eye(n, dtype=bool) # 自分自身とは「似ている」
+    # 意味ごとに使われている文字の集合を先に作っておく
+    char_sets = [frozenset(t) for t in texts]
+    # 似ているかどうかは対称なので、上三角（j > i）だけ計算して下三角に写す
+    for i in range(n):
+        for j in range(i + 1, n):
+            # 共通の文字が1つも無ければ類似度は0なので、計算するまでもなく「似ていない」
+            if char_sets[i].isdisjoint(char_sets[j]):
+                continue
+            if is_similar(texts[i], texts[j], threshold):
+                similar[i, j] = similar[j, i] = True
+    return similar
+
 def initialize_quiz(course_name, num_questions, time_limit, use_ai_mode):
     """選択されたコースでクイズを初期化する"""
     filename = QUIZ_FILES[course_name]
     word_data = load_data(filename)
     
-    if not word_data:
+    if word_data is None:
         st.error(f"エラー: データファイル（{filename}）の読み込みに失敗しました。")
         return False
 
-    if len(word_data) < 4:
+    if len(word_data.words) < 4:
         st.error("データが不足しています。最低4単語必要です。")
         return False
 
-    words = list(word_data.keys())
+    words = word_data.words
     actual_num = min(num_questions, len(words))
 
+    # 単語リストはコピーせず、出題する単語の位置（インデックス）だけを選ぶ
     if use_ai_mode:
-        question_words = get_weighted_questions(words, actual_num)
+        question_ids = get_weighted_questions(words, actual_num)
     else:
-        question_words = random.sample(words, actual_num)
+        question_ids = random.sample(range(len(words)), actual_num)
     
+    # セッションには出題する位置だけを保存し、単語データ本体は load_data のキャッシュから引く
     st.session_state.quiz_data = {
         'course_name': course_name,
-        'words_dict': word_data,
-        'question_words': question_words,
+        'filename': filename,
+        'question_ids': question_ids,
         'total_questions': actual_num,
         'time_limit': time_limit,
-        'use_ai_mode': use_ai_mode # モード情報を保存
+        'use_ai_mode': use_ai_mode, # モード情報を保存
+        # 全問の選択肢を最初にまとめて作っておき、問題の切り替え時は読むだけにする
+        'all_choices': [make_choices(filename, q_id) for q_id in question_ids]
     }
     st.session_state.current_index = 0
+    st.session_state.question_started_at = time.time()
     st.session_state.score = 0
     st.session_state.quiz_finished = False
-    st.session_state.current_choices = None
     st.session_state.last_result = None
     
     return True
 
-def check_answer(selected_meaning):
-    """回答チェック処理"""
-    q_word = st.session_state.quiz_data['question_words'][st.session_state.current_index]
-    correct_meaning = st.session_state.quiz_data['words_dict'][q_word]
+def get_current_question():
+    """出題中の問題の（位置, 単語, 正解の意味）を返す"""
+    word_data = load_data(st.session_state.quiz_data['filename']) # キャッシュを引くだけ
+    q_id = st.session_state.quiz_data['question_ids'][st.session_state.current_index]
+    return q_id, word_data.words[q_id], word_data.meanings[q_id]
+
+def check_answer(question_index, selected_id):
+    """回答チェック処理（ボタンを出した問題の番号と、選んだ選択肢の意味の位置を受け取る）"""
+    # 時間切れなどで既に次の問題へ進んでいたら、前の問題のボタン操作は無視する
+    # （そのまま採点すると次の問題の回答として扱われ、最後の問題の後では範囲外になる）
+    if question_index != st.session_state.current_index or st.session_state.quiz_finished:
+        return
+
+    q_id, q_word, correct_meaning = get_current_question()
     
-    is_correct = (selected_meaning == correct_meaning)
+    # 正解と同じ意味の選択肢は正解の1つだけなので、位置を比べれば済む
+    is_correct = (selected_id == q_id)
     
     # 履歴保存
     save_history(q_word, is_correct)
@@ -199,8 +377,7 @@ def check_answer(selected_meaning):
 
 def handle_time_up():
     """時間切れ時の処理"""
-    q_word = st.session_state.quiz_data['question_words'][st.session_state.current_index]
-    correct_meaning = st.session_state.quiz_data['words_dict'][q_word]
+    q_id, q_word, correct_meaning = get_current_question()
     
     # 時間切れメッセージを設定
     save_history(q_word, False)
@@ -211,17 +388,143 @@ def handle_time_up():
 def move_to_next():
     """次の問題へ進む共通処理"""
     st.session_state.current_index += 1
-    st.session_state.current_choices = None
+    # 次の問題の制限時間はここから数える
+    st.session_state.question_started_at = time.time()
     
     if st.session_state.current_index >= st.session_state.quiz_data['total_questions']:
         st.session_state.quiz_finished = True
+        # クイズが終わったら残りの履歴を書き出す（「もう一度挑戦」のAIモードにも反映させる）
+        flush_history()
 
 def go_to_menu():
     """メニュー画面に戻る"""
+    flush_history() # ダッシュボードに反映されるよう、残りの履歴を書き出す
     st.session_state.page = "menu"
     if 'quiz_data' in st.session_state:
         del st.session_state['quiz_data']
 
+# --- 自動選別ロジック、意味が似ている単語を選択肢からはじく---
+def make_choices(filename, q_id):
+    """q_id の単語の4択（正解1つ＋似ていない誤答3つ、シャッフル済み）を意味の位置のリストで作る"""
+    word_data = load_data(filename)
+    all_meanings = word_data.meanings
+    similar = word_data.similar
+    # 類似度行列は位置で引く（単語と意味は同じ位置に並んでいる）
+    correct_meaning = all_meanings[q_id]
+
+    # チェック1・2: 正解そのもの／正解と日本語が似すぎているものを外す
+    # （同じ文字列は「似ている」扱いなので、正解と同じ意味もここで消える）
+    pool = np.flatnonzero(~similar[q_id])
+    pool = pool[pool != q_id]
+    # 「まだ選べる」誤答候補のマスク
+    eligible = np.ones(len(all_meanings), dtype=bool)
+
+    # 誤答候補（意味の位置）を入れるリスト
+    distractor_ids = []
+    # 候補一覧全体はシャッフルせず、必要な3つだけをまだ選べるものからランダムに引く
+    for _ in range(3):
+        remaining = pool[eligible[pool]]
+        if len(remaining) == 0:
+            break
+
+        # 合格したものを採用
+        i = np.random.choice(remaining)
+        distractor_ids.append(i)
+
+        # チェック3: 選んだ誤答と似ているものも候補から外す（選択肢同士の被り防止）
+        eligible &= ~similar[i]
+
+    # 万が一、厳しすぎて候補が足りない場合の安全策（似ているものも含めてランダムな順番で埋める）
+    # 全体を一巡したら終わるので、意味の種類が少なすぎても無限ループにならない
+    if len(distractor_ids) < 3:
+        used = {correct_meaning} | {all_meanings[i] for i in distractor_ids}
+        for i in np.random.permutation(len(all_meanings)):
+            if all_meanings[i] not in used:
+                distractor_ids.append(i)
+                used.add(all_meanings[i])
+                if len(distractor_ids) >= 3:
+                    break
+
+    # セッションに置くのでnumpyの整数ではなくPythonのintにしておく
+    choices = [int(i) for i in distractor_ids]
+    choices.append(q_id)
+    random.shuffle(choices)
+    return choices
+
+# 出題部分だけをfragmentにして、回答時はここだけを再実行する
+# （ファイル読み込み・CSS・ヘッダーなどは再実行しない）
+@st.fragment
+def question_view():
+    """出題中の画面（問題文・選択肢・制限時間）を表示する"""
+    # 最後の問題に答えた直後は、結果発表を出すためにページ全体を再実行する
+    if st.session_state.quiz_finished:
+        st.rerun()
+
+    # 正誤表示
+    if st.session_state.last_result:
+        msg, type_ = st.session_state.last_result
+        if type_ == "success":
+            st.success(msg)
+        else:
+            st.error(msg)
+        st.session_state.last_result = None
+
+    # 問題表示
+    current_idx = st.session_state.current_index
+    total_q = st.session_state.quiz_data['total_questions']
+    _, q_word, _ = get_current_question()
+    all_meanings = load_data(st.session_state.quiz_data['filename']).meanings
+
+    # 制限時間の取得
+    limit_sec = st.session_state.quiz_data.get('time_limit', 0)
+    # タイマー表示用のプレースホルダー（空き地）を作っておく
+    # ここに後でバーを表示します
+    timer_placeholder = st.empty()
+
+    # 進捗バーと問題文
+    st.progress((current_idx) / total_q)
+    st.markdown(f"### Q{current_idx + 1}.  **{q_word}**")
+
+    # ボタン表示（選択肢はクイズ開始時に全問ぶん作成済み、中身は意味の位置）
+    choices = st.session_state.quiz_data['all_choices'][current_idx]
+    for i, choice_id in enumerate(choices):
+        # ボタンが押されたら再実行の前に check_answer が走るので、st.rerun()は不要
+        st.button(
+            all_meanings[choice_id], use_container_width=True, key=f"ans_{current_idx}_{i}",
+            on_click=check_answer, args=(current_idx, choice_id)
+        )
+
+    #制限時間のカウントダウン
+    if limit_sec > 0:
+        # バーが減っていく様子はブラウザ側のCSSアニメーションに任せる（サーバーからの更新は不要）
+        # アニメーション名を問題ごとに変えて、次の問題で最初から動き直すようにする
+        with timer_placeholder.container():
+            st.markdown(f"""
+<style>@keyframes timer-q{current_idx} {{ from {{ width: 100%; }} to {{ width: 0%; }} }}</style>
+<div class="timer-bar"><div style="animation: timer-q{current_idx} {limit_sec}s linear forwards;"></div></div>
+""", unsafe_allow_html=True)
+            # 時間切れの確認は別のfragmentで行い、ここでは待たない
+            # （待機中はボタン操作が受け付けられないため）
+            countdown(current_idx, limit_sec)
+
+@st.fragment(run_every=0.5)
+def countdown(question_index, limit_sec):
+    """残り時間を表示し、時間切れなら次の問題へ進める（0.5秒ごとに自動で再実行される）"""
+    # 回答済みで次の問題に進んでいれば何もしない
+    if question_index != st.session_state.current_index or st.session_state.quiz_finished:
+        return
+
+    remaining = limit_sec - (time.time() - st.session_state.question_started_at)
+    if remaining > 0:
+        # 表示は1秒単位にして、0.5秒ごとの確認のたびに内容が変わらないようにする
+        st.caption(f"⏳ {math.ceil(remaining)} 秒")
+        return
+
+    # 時間切れ！
+    handle_time_up()
+    # 問題の表示はこのfragmentの外にあるので、ページ全体を再実行して次の問題（または結果発表）へ
+    st.rerun()
+
 # ==========================================
 # メイン処理
 # ==========================================
@@ -231,6 +534,13 @@ if 'page' not in st.session_state:
 
 # --- 画面1: メニュー画面 ---
 if st.session_state.page == "menu":
+    # 以前のCSV形式の学習履歴があれば、先にデータベースへ取り込んでおく
+    if os.path.exists(LEGACY_HISTORY_FILE):
+        try:
+            open_history_db().close()
+        except Exception as e:
+            st.error(f"以前の学習履歴の取り込みに失敗しました: {e}")
+
     st.title("単語クイズ for TOEIC 📚")
     st.write("コースを選んでスタート！")
 
@@ -271,11 +581,11 @@ if st.session_state.page == "menu":
     
     if os.path.exists(HISTORY_FILE):
         try:
-            df = pd.read_csv(HISTORY_FILE)
-            if not df.empty:
+            stats = load_history_stats(HISTORY_FILE, os.path.getmtime(HISTORY_FILE))
+            if stats['total'] > 0:
                 # 1. 基本スタッツの表示
-                total_answers = len(df)
-                total_correct = df['IsCorrect'].sum()
+                total_answers = stats['total']
+                total_correct = stats['correct']
                 accuracy = (total_correct / total_answers) * 100
                 
                 col1, col2, col3 = st.columns(3)
@@ -283,13 +593,9 @@ if st.session_state.page == "menu":
                 col2.metric("正解数", f"{total_correct}問")
                 col3.metric("正答率", f"{accuracy:.1f}%")
                 
-                # 2. 日別学習量のグラフ
-                # Timestamp列を日時型に変換して、日付ごとの回答数を集計
-                df['Date'] = pd.to_datetime(df['Timestamp']).dt.date
-                daily_counts = df.groupby('Date')['IsCorrect'].count()
-                
+                # 2. 日別学習量のグラフ（日付ごとの回答数は集計済み）
                 st.write("##### 📅 日々の学習量")
-                st.bar_chart(daily_counts)
+                st.bar_chart(stats['daily'])
 
                 st.write("")
                 with st.expander("🗑️ データの管理（リセット）"):
@@ -320,9 +626,8 @@ elif st.session_state.page == "quiz":
         mode_text = "🔥AIモード" if st.session_state.quiz_data.get('use_ai_mode') else "通常モード"
         st.caption(f"挑戦中: {st.session_state.quiz_data['course_name']} ({mode_text})")
     with col2:
-        if st.button("中断", key="back_btn"):
-            go_to_menu()
-            st.rerun()
+        # on_clickのコールバックで画面を切り替える（st.rerun()による2回目の再実行が不要）
+        st.button("中断", key="back_btn", on_click=go_to_menu)
 
     # 結果発表
     if st.session_state.quiz_finished:
@@ -357,121 +662,8 @@ elif st.session_state.page == "quiz":
 
         with col_menu:
             # メニューに戻るボタン
-            if st.button("メニューに戻る 🏠", use_container_width=True):
-                go_to_menu()
-                st.rerun()
+            st.button("メニューに戻る 🏠", use_container_width=True, on_click=go_to_menu)
             
     # 出題中
     else:
-        # 正誤表示
-        if st.session_state.last_result:
-            msg, type_ = st.session_state.last_result
-            if type_ == "success":
-                st.success(msg)
-            else:
-                st.error(msg)
-            st.session_state.last_result = None
-
-        # 問題表示
-        current_idx = st.session_state.current_index
-        total_q = st.session_state.quiz_data['total_questions']
-        q_word = st.session_state.quiz_data['question_words'][current_idx]
-        correct_meaning = st.session_state.quiz_data['words_dict'][q_word]
-
-        # 制限時間の取得
-        limit_sec = st.session_state.quiz_data.get('time_limit', 0)
-        # タイマー表示用のプレースホルダー（空き地）を作っておく
-        # ここに後でバーを表示します
-        timer_placeholder = st.empty()
-
-        # 進捗バーと問題文
-        st.progress((current_idx) / total_q)
-        st.markdown(f"### Q{current_idx + 1}.  **{q_word}**")
-
-        # --- 自動選別ロジック、意味が似ている単語を選択肢からはじく---
-        if st.session_state.current_choices is None:
-            all_meanings = list(st.session_state.quiz_data['words_dict'].values())
-            
-            # 誤答候補を入れるリスト
-            distractors = []
-            
-            # 全単語リストをシャッフルして、一つずつチェックしていく
-            random.shuffle(all_meanings)
-            
-            for candidate in all_meanings:
-                # 誤答が3つ集まったら終了
-                if len(distractors) >= 3:
-                    break
-                
-                # チェック1: 正解そのものではないか？
-                if candidate == correct_meaning:
-                    continue
-                
-                # チェック2: 正解と日本語が似すぎていないか？
-                if is_similar(candidate, correct_meaning, threshold=0.4):
-                    continue # 似ているのでスキップ
-                
-                # チェック3: すでに選んだ誤答と似すぎていないか？（選択肢同士の被り防止）
-                is_duplicate = False
-                for existing_distractor in distractors:
-                    if is_similar(candidate, existing_distractor, threshold=0.4):
-                        is_duplicate = True
-                        break
-                if is_duplicate:
-                    continue
-                
-                # 合格したものを採用
-                distractors.append(candidate)
-            
-            # 万が一、厳しすぎて候補が足りない場合の安全策（ランダムで埋める）
-            while len(distractors) < 3:
-                m = random.choice(all_meanings)
-                if m != correct_meaning and m not in distractors:
-                    distractors.append(m)
-
-            choices = distractors
-            choices.append(correct_meaning)
-            random.shuffle(choices)
-            st.session_state.current_choices = choices
-
-        # ボタン表示
-        choices = st.session_state.current_choices
-        for choice in choices:
-            if st.button(choice, use_container_width=True):
-                # ボタンが押されたら check_answer が走って rerun され、下のループは中断される
-                check_answer(choice)
-                st.rerun()
-
-        #制限時間のカウントダウン
-        # ボタン表示の下に書くことで、ボタン描画後に待機ループに入る
-        if limit_sec > 0:
-            # バーを表示するコンテナ
-            with timer_placeholder.container():
-                progress_bar = st.progress(1.0) # 最初は満タン(1.0)
-                status_text = st.empty()
-            
-            # カウントダウンループ
-            # Streamlitの仕様上、このループ中にボタンが押されると
-            # ループは中断され、スクリプトが再実行(rerun)されます。
-            # つまり、時間切れになる前にボタンを押せばOKということです。
-            
-            start_time = time.time()
-            while True:
-                elapsed = time.time() - start_time
-                remaining = limit_sec - elapsed
-                
-                if remaining <= 0:
-                    # 時間切れ！
-                    progress_bar.progress(0.0)
-                    status_text.write("⏳ 0.0 秒")
-                    handle_time_up() # 時間切れ処理を実行
-                    st.rerun() # 強制リロードして次の問題へ
-                    break
-                
-                # バーと時間を更新
-                ratio = max(0.0, remaining / limit_sec)
-                progress_bar.progress(ratio)
-                
-                # 少し待機（この間にボタンクリックを検知させる）
-                time.sleep(0.1)
-            
+        question_view()